@@ -18,7 +18,7 @@ setup(
   ],
   install_requires=[
     'einops>=0.3',
-    'torch>=1.6'
+    'torch>=2.5'
   ],
   classifiers=[
     'Development Status :: 4 - Beta',
@@ -1,22 +1,21 @@
+from contextlib import ExitStack, contextmanager, nullcontext
+from functools import lru_cache, partial
+
 import torch
 import torch.nn.functional as F
 from torch import nn, einsum
-from flash_attn import flash_attn_qkvpacked_func
+from torch.utils.checkpoint import checkpoint, CheckpointPolicy, create_selective_checkpoint_contexts
+from torch.nn.attention import SDPBackend, sdpa_kernel
 
-from einops import rearrange, repeat
+from einops import rearrange
 
 # feedforward and attention
 
-class GEGLU(nn.Module):
-    def forward(self, x):
-        x, gates = x.chunk(2, dim = -1)
-        return x * F.gelu(gates)
-
 def FeedForward(dim, mult = 4, dropout = 0.):
     return nn.Sequential(
         nn.LayerNorm(dim),
-        nn.Linear(dim, dim * mult * 2),
-        GEGLU(),
+        nn.Linear(dim, dim * mult),
+        nn.GELU(),
         nn.Dropout(dropout),
         nn.Linear(dim * mult, dim)
     )
@@ -27,8 +26,7 @@ class Attention(nn.Module):
         dim,
         heads = 8,
         dim_head = 64,
-        dropout = 0.,
-        use_flash_attn = False
+        dropout = 0.
     ):
         super().__init__()
         inner_dim = dim_head * heads
@@ -41,38 +39,102 @@ class Attention(nn.Module):
         self.to_out = nn.Linear(inner_dim, dim, bias = False)
 
         self.dropout = nn.Dropout(dropout)
-        self.use_flash_attn = use_flash_attn
 
-    def forward(self, x, return_attn=False):
+    def forward(self, x, return_attn=False, residual=None):
         h = self.heads
 
         x = self.norm(x)
 
-        qkv = self.to_qkv(x)
-        qkv = qkv.chunk(3, dim=-1)
-        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h=h), qkv)
-
-        if self.use_flash_attn:
-            out = flash_attn_qkvpacked_func(
-                torch.stack([q, k, v], dim=2),
-                dropout_p=self.dropout.p,
-                softmax_scale=self.scale,
-                causal=False,
-            )
-            out = rearrange(out, 'b h n d -> b n (h d)')
-        else:
+        b, n, _ = x.shape
+
+        # keep qkv packed as (b, n, 3, h, d) - q, k, v are strided views into it, no copies
+
+        qkv = self.to_qkv(x).view(b, n, 3, h, -1)
+        q, k, v = qkv.permute(2, 0, 3, 1, 4).unbind(0)
+
+        if return_attn:
             sim = einsum('b h i d, b h j d -> b h i j', q, k) * self.scale
 
             attn = sim.softmax(dim=-1)
-            attn = self.dropout(attn)
+            dropped_attn = self.dropout(attn)
+
+            out = einsum('b h i j, b h j d -> b i h d', dropped_attn, v)
+        else:
+            out = F.scaled_dot_product_attention(
+                q, k, v,
+                dropout_p=self.dropout.p if self.training else 0.,
+                scale=self.scale
+            ).transpose(1, 2)
+
+        out = out.reshape(b, n, -1)
+
+        # when handed the residual, fold the add into the bias-free output projection as a single addmm
+        # skipped under autocast, where addmm would also cast the float32 residual stream down
 
-            out = einsum('b h i j, b h j d -> b h i d', attn, v)
-            out = rearrange(out, 'b h n d -> b n (h d)')
+        if residual is not None and not torch.is_autocast_enabled(x.device.type):
+            out = torch.addmm(residual.reshape(b * n, -1), out.reshape(b * n, -1), self.to_out.weight.t())
+            out = out.view(b, n, -1)
+        else:
+            out = self.to_out(out)
+
+            if residual is not None:
+                out = out + residual
 
-        return self.to_out(out)
+        if not return_attn:
+            return out
+
+        return out, attn
 
 # transformer
 
+# selective activation checkpointing - keep the matmul and attention outputs, recompute the cheap pointwise ops in between
+
+CHECKPOINT_SAVE_OPS = {
+    torch.ops.aten.mm.default,
+    torch.ops.aten.addmm.default,
+    torch.ops.aten.bmm.default,
+    torch.ops.aten._scaled_dot_product_flash_attention.default,
+    torch.ops.aten._scaled_dot_product_efficient_attention.default,
+    torch.ops.aten._scaled_dot_product_cudnn_attention.default,
+    torch.ops.aten._scaled_dot_product_flash_attention_for_cpu.default,
+}
+
+def checkpoint_policy(ctx, op, *args, **kwargs):
+    if op in CHECKPOINT_SAVE_OPS:
+        return CheckpointPolicy.MUST_SAVE
+
+    return CheckpointPolicy.PREFER_RECOMPUTE
+
+def selective_checkpoint_context(restore_sdpa_backends = False):
+    forward_context, recompute_context = create_selective_checkpoint_contexts(checkpoint_policy)
+
+    if not restore_sdpa_backends:
+        return forward_context, recompute_context
+
+    # the recompute runs during backward, after Transformer.forward has left its sdpa backend selection
+    # re-enter it there, otherwise attention can be recomputed with a different kernel than the checkpointed forward used
+
+    return forward_context, nested_contexts(recompute_context, sdpa_backend_context(True))
+
+# sdpa backends for use_flash_attn - every backend except cudnn attention
+
+SDPA_FLASH_BACKENDS = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION, SDPBackend.MATH]
+
+def sdpa_backend_context(use_flash_attn):
+    return sdpa_kernel(SDPA_FLASH_BACKENDS) if use_flash_attn else nullcontext()
+
+@contextmanager
+def nested_contexts(*contexts):
+    with ExitStack() as stack:
+        for context in contexts:
+            stack.enter_context(context)
+
+        yield
+
+def transformer_block(x, attn, ff):
+    x = attn(x, residual=x)
+    return ff(x) + x
+
 class Transformer(nn.Module):
     def __init__(
         self,
@@ -83,41 +145,75 @@ class Transformer(nn.Module):
         attn_dropout,
         ff_dropout,
         checkpoint_grads=False,
-        use_flash_attn=False
+        use_flash_attn=False,
+        compile=False,
+        compile_mode='reduce-overhead'
     ):
         super().__init__()
         self.layers = nn.ModuleList([])
 
         for _ in range(depth):
             self.layers.append(nn.ModuleList([
-                Attention(dim, heads=heads, dim_head=dim_head, dropout=attn_dropout, use_flash_attn=use_flash_attn),
+                Attention(dim, heads=heads, dim_head=dim_head, dropout=attn_dropout),
                 FeedForward(dim, dropout=ff_dropout),
             ]))
 
         self.checkpoint_grads = checkpoint_grads
 
-    def forward(self, x, return_attn=False):
-        post_softmax_attns = []
+        # use_flash_attn limits sdpa to the flash attention, memory efficient and math backends
+        # in effect this only keeps it off the cudnn attention backend, so flash attention runs wherever its inputs are eligible
 
-        for attn, ff in self.layers:
-            if return_attn:
-                attn_out, post_softmax_attn = attn(x, return_attn=True)
-                post_softmax_attns.append(post_softmax_attn)
-            else:
-                attn_out = attn(x, return_attn=False)
+        self.use_flash_attn = use_flash_attn
 
+        # optionally compile the attention-free forward with static shapes, so the layer loop is unrolled into one graph
+        # and its many small pointwise kernels are fused and replayed with cuda graphs
+        # compile_mode = 'max-autotune' additionally lets inductor fold bias and residual adds into its own matmul epilogues,
+        # at the cost of a much slower compile for every new input shape
+
+        self.compile_mode = compile_mode if compile else None
+
+    def _forward_noattn(self, x, compiled = False):
+        # under torch.compile the sdpa backend is fixed when the graph is traced, so the recompute cannot diverge from it
+        context_fn = partial(selective_checkpoint_context, self.use_flash_attn and not compiled)
+
+        for attn, ff in self.layers:
             if self.checkpoint_grads:
-                x = torch.utils.checkpoint.checkpoint(lambda: attn_out + x)
-                x = torch.utils.checkpoint.checkpoint(ff, x) + x
+                x = checkpoint(transformer_block, x, attn, ff, use_reentrant=False, context_fn=context_fn)
             else:
-                x = attn_out + x
-                x = ff(x) + x
+                x = transformer_block(x, attn, ff)
 
-        if not return_attn:
-            return x
+        return x
+
+    def _forward_with_attn(self, x):
+        post_softmax_attns = []
+
+        for attn, ff in self.layers:
+            x, post_softmax_attn = attn(x, return_attn=True, residual=x)
+            post_softmax_attns.append(post_softmax_attn)
+
+            x = ff(x) + x
 
         return x, torch.stack(post_softmax_attns)
 
+    def forward(self, x, return_attn=False):
+        # backend selection wraps the compiled region rather than living inside attention, as dynamo cannot trace sdpa_kernel
+
+        with sdpa_backend_context(self.use_flash_attn):
+            if return_attn:
+                return self._forward_with_attn(x)
+
+            if self.compile_mode is not None:
+                return compiled_forward_noattn(self.compile_mode)(self, x, compiled = True)
+
+            return self._forward_noattn(x)
+
+# the compiled forward is an unbound function built lazily once per mode, and is handed the module as an argument
+# nothing compiled is stored on the instance, so deepcopies and pickles of a compiled model stay self-contained
+
+@lru_cache(maxsize=None)
+def compiled_forward_noattn(mode):
+    return torch.compile(Transformer._forward_noattn, mode=mode, dynamic=False, fullgraph=True)
+
 # numerical embedder
 
 class NumericalEmbedder(nn.Module):
@@ -128,7 +224,7 @@ class NumericalEmbedder(nn.Module):
 
     def forward(self, x):
         x = rearrange(x, 'b n -> b n 1')
-        return x * self.weights + self.biases
+        return torch.addcmul(self.biases, x, self.weights)
 
 # main class
 
@@ -147,7 +243,10 @@ class FTTransformer(nn.Module):
         attn_dropout = 0.,
         ff_dropout = 0.,
         checkpoint_grads=False,
-        use_flash_attn=False
+        use_flash_attn=False,
+        use_amp=False,
+        compile=False,
+        compile_mode='reduce-overhead'
     ):
         super().__init__()
         assert all(map(lambda n: n > 0, categories)), 'number of each category must be positive'
@@ -167,7 +266,7 @@ class FTTransformer(nn.Module):
 
         if self.num_unique_categories > 0:
             categories_offset = F.pad(torch.tensor(list(categories)), (1, 0), value = num_special_tokens)
-            categories_offset = categories_offset.cumsum(dim = -1)[:-1]
+            categories_offset = categories_offset.cumsum(dim = -1, dtype = torch.int32)[:-1]  # int32 ids halve the index bandwidth of the embedding gather
             self.register_buffer('categories_offset', categories_offset)
 
             # categorical embedding
@@ -195,9 +294,19 @@ class FTTransformer(nn.Module):
             attn_dropout = attn_dropout,
             ff_dropout = ff_dropout,
             checkpoint_grads=checkpoint_grads,
-            use_flash_attn=use_flash_attn
+            use_flash_attn=use_flash_attn,
+            compile=compile,
+            compile_mode=compile_mode
         )
 
+        # optionally compile the token embedding as well, with the same mode and static shapes as the transformer forward
+
+        self.compile_mode = compile_mode if compile else None
+
+        # bfloat16 autocast around the transformer - layernorm and softmax stay in float32 per the autocast op lists
+
+        self.use_amp = use_amp
+
         # to logits
 
         self.to_logits = nn.Sequential(
@@ -206,36 +315,42 @@ class FTTransformer(nn.Module):
             nn.Linear(dim, dim_out)
         )
 
-    def forward(self, x_categ, x_numer, device, return_attn=False):
-        x_categ = x_categ.to(device)
-        x_numer = x_numer.to(device)
-        
-        assert x_categ.shape[-1] == self.num_categories, f'you must pass in {self.num_categories} values for your categories input'
+    def _embed(self, x_categ, x_numer):
+        b = x_categ.shape[0]
+
+        # cls token first, as an expanded view, so the whole sequence is allocated and copied by a single concat
+        xs = [self.cls_token.expand(b, -1, -1)]
 
-        xs = []
         if self.num_unique_categories > 0:
-            x_categ = x_categ + self.categories_offset
-            x_categ = self.categorical_embeds(x_categ)
-            xs.append(x_categ)
+            # offset add and lookup as one functional gather, which inductor fuses when compiled
+            xs.append(F.embedding(x_categ.int() + self.categories_offset, self.categorical_embeds.weight))
 
         # add numerically embedded tokens
         if self.num_continuous > 0:
-            x_numer = self.numerical_embedder(x_numer)
-            xs.append(x_numer)
+            xs.append(self.numerical_embedder(x_numer))
 
-        # concat categorical and numerical
-        x = torch.cat(xs, dim=1)
+        return torch.cat(xs, dim=1)
 
-        # append cls tokens
-        b = x.shape[0]
-        cls_tokens = repeat(self.cls_token, '1 1 d -> b 1 d', b=b)
-        x = torch.cat((cls_tokens, x), dim=1)
+    def embed(self, x_categ, x_numer):
+        if self.compile_mode is not None:
+            return compiled_embed(self.compile_mode)(self, x_categ, x_numer)
 
-        # attend
-        if return_attn:
-            x, attns = self.transformer(x, return_attn=True)
-        else:
-            x = self.transformer(x, return_attn=False)
+        return self._embed(x_categ, x_numer)
+
+    def forward(self, x_categ, x_numer, device, return_attn=False):
+        x_categ = x_categ.to(device)
+        x_numer = x_numer.to(device)
+        
+        assert x_categ.shape[-1] == self.num_categories, f'you must pass in {self.num_categories} values for your categories input'
+
+        x = self.embed(x_categ, x_numer)
+
+        # attend, with the attention and feedforward matmuls optionally in bfloat16
+        with torch.autocast(device_type=x.device.type, dtype=torch.bfloat16, enabled=self.use_amp):
+            if return_attn:
+                x, attns = self.transformer(x, return_attn=True)
+            else:
+                x = self.transformer(x, return_attn=False)
 
         # get cls token
         x = x[:, 0]
@@ -248,57 +363,32 @@ class FTTransformer(nn.Module):
 
         return logits, attns
 
-    def get_embeddings(self, x_categ, x_cont, batch_size=None):
+    def get_embeddings(self, x_categ, x_cont, batch_size=None, output_device=None):
         device = next(self.parameters()).device
-        x_categ = x_categ.to(device)
-        x_cont = x_cont.to(device)
+        output_device = output_device if output_device is not None else device
 
-        if batch_size is None:
-            xs = []
-            if self.num_unique_categories > 0:
-                x_categ = x_categ.long() + self.categories_offset  # Cast x_categ to long tensor
-                x_categ = self.categorical_embeds(x_categ)
-                xs.append(x_categ)
+        # cast x_categ to int32 once up front - both calls are no-ops for tensors already on device with the right dtype
+        x_categ = x_categ.to(device, dtype=torch.int32, non_blocking=True)
+        x_cont = x_cont.to(device, non_blocking=True)
 
-            if self.num_continuous > 0:
-                x_cont = self.numerical_embedder(x_cont)
-                xs.append(x_cont)
+        num_rows = x_categ.size(0)
+        batch_size = batch_size if batch_size is not None else max(num_rows, 1)
 
-            x = torch.cat(xs, dim=1)
-            b = x.shape[0]
-            cls_tokens = repeat(self.cls_token, '1 1 d -> b 1 d', b=b)
-            x = torch.cat((cls_tokens, x), dim=1)
+        # write each batch into a preallocated output, rather than holding a list of batches and concatenating them at the end
+        embeddings = torch.empty(num_rows, self.num_categories + self.num_continuous, self.cls_token.shape[-1], device=output_device, dtype=self.cls_token.dtype)
 
-            x = self.transformer(x, return_attn=False)
-            embeddings = x[:, 1:]  # Exclude the CLS token from the embeddings
-            return embeddings.to(device)
-        else:
-            embeddings = []
-            for i in range(0, x_categ.size(0), batch_size):
-                start = i
-                end = min(start + batch_size, x_categ.size(0))
-
-                x_categ_batch = x_categ[start:end]
-                x_cont_batch = x_cont[start:end]
+        for start in range(0, num_rows, batch_size):
+            end = min(start + batch_size, num_rows)
 
-                xs = []
-                if self.num_unique_categories > 0:
-                    x_categ_batch = x_categ_batch.long() + self.categories_offset  # Cast x_categ_batch to long tensor
-                    x_categ_batch = self.categorical_embeds(x_categ_batch)
-                    xs.append(x_categ_batch)
+            x = self.embed(x_categ[start:end], x_cont[start:end])
 
-                if self.num_continuous > 0:
-                    x_cont_batch = self.numerical_embedder(x_cont_batch)
-                    xs.append(x_cont_batch)
+            x = self.transformer(x, return_attn=False)
+            embeddings[start:end] = x[:, 1:]  # Exclude the CLS token from the embeddings
 
-                x = torch.cat(xs, dim=1)
-                b = x.shape[0]
-                cls_tokens = repeat(self.cls_token, '1 1 d -> b 1 d', b=b)
-                x = torch.cat((cls_tokens, x), dim=1)
+        return embeddings
 
-                x = self.transformer(x, return_attn=False)
-                batch_embeddings = x[:, 1:]  # Exclude the CLS token from the embeddings
-                embeddings.append(batch_embeddings)
+# compiled like the transformer forward - an unbound function built lazily once per mode, with the module passed in as an argument
 
-            embeddings = torch.cat(embeddings, dim=0)
-            return embeddings.to(device)
\ No newline at end of file
+@lru_cache(maxsize=None)
+def compiled_embed(mode):
+    return torch.compile(FTTransformer._embed, mode=mode, dynamic=False, fullgraph=True)
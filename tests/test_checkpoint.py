@@ -0,0 +1,39 @@
+import pytest
+import torch
+from torch.nn.attention import SDPBackend
+
+from tab_transformer_pytorch import TabTransformer, FTTransformer
+from tab_transformer_pytorch import ft_transformer, tab_transformer_pytorch
+
+# narrowing use_flash_attn to the math backend makes any recompute outside of it pick a different sdpa kernel than the forward
+
+@pytest.mark.parametrize('module', (ft_transformer, tab_transformer_pytorch))
+def test_checkpoint_backward_with_flash_attn(module, monkeypatch):
+    monkeypatch.setattr(module, 'SDPA_FLASH_BACKENDS', [SDPBackend.MATH])
+
+    model_kwargs = dict(
+        categories = (10, 5, 6, 5, 8),
+        num_continuous = 10,
+        dim = 32,
+        dim_out = 1,
+        depth = 2,
+        heads = 4,
+        attn_dropout = 0.1,
+        ff_dropout = 0.1,
+        checkpoint_grads = True,
+        use_flash_attn = True
+    )
+
+    x_categ = torch.randint(0, 5, (4, 5))
+    x_cont = torch.randn(4, 10)
+
+    if module is ft_transformer:
+        model = FTTransformer(**model_kwargs)
+        pred = model(x_categ, x_cont, 'cpu')
+    else:
+        model = TabTransformer(**model_kwargs)
+        pred = model(x_categ, x_cont)
+
+    pred.sum().backward()
+
+    assert all(param.grad is not None for param in model.transformer.parameters())